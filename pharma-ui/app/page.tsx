@@ -292,11 +292,11 @@ export default function Home() {
                 </div>
 
                 <div>
-                  <label className={`block text-xs ${current.textMuted} mb-2`}>Genomic File (.vcf)</label>
+                  <label className={`block text-xs ${current.textMuted} mb-2`}>Genomic File (.vcf, .vcf.gz)</label>
                   <div className="relative">
                     <input 
                       type="file" 
-                      accept=".vcf"
+                      accept=".vcf,.gz"
                       className="hidden"
                       id="file-upload"
                       onChange={(e) => setFile(e.target.files?.[0] || null)}
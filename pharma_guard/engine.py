@@ -3,8 +3,9 @@ Clinical Risk Engine for PharmaGuard
 RIFT 2026 Hackathon - Complete CPIC-aligned rules for all 6 drugs
 """
 
-from typing import List, Dict, Any
-from parser import get_variants_by_gene, get_diplotype, get_phenotype
+from functools import lru_cache
+from typing import List, Dict, Any, Iterable, NamedTuple, Optional, Tuple
+from parser import Variant, VariantTable, diplotype_from_calls, get_phenotype
 
 # CPIC guideline references
 CPIC_GUIDELINES = {
@@ -16,280 +17,306 @@ CPIC_GUIDELINES = {
     "FLUOROURACIL": "CPIC Guideline for Fluorouracil and DPYD (Level A)",
 }
 
-def get_clinical_risk(variants: List[Dict], drug: str) -> Dict[str, Any]:
+# High-risk DPYD alleles
+HIGH_RISK_DPYD = frozenset(("*2A", "*13", "HapB3"))
+
+# Number of variant alleles carried for each called genotype
+ALLELE_DOSE = {"0/1": 1, "1/0": 1, "0|1": 1, "1|0": 1, "1/1": 2, "1|1": 2}
+
+# Phenotype category for a variant allele dose
+DOSE_CATEGORY = {0: "NM", 1: "IM", 2: "PM"}
+
+# Rule outcomes per (drug, phenotype category). Categories: NM (standard
+# dosing), IM, PM, RM. "phenotype" overrides the CPIC phenotype call for
+# genes scored by allele count rather than diplotype.
+RECOMMENDATIONS = {
+    ("CODEINE", "NM"): {
+        "label": "Safe",
+        "severity": "none",
+        "recommendation": "Use codeine with standard dosing.",
+        "confidence_score": 0.85
+    },
+    ("CODEINE", "PM"): {
+        "label": "Toxic",
+        "severity": "high",
+        "recommendation": "AVOID codeine. Poor metabolizers risk morphine toxicity. Use non-opioid analgesics or alternative opioids not dependent on CYP2D6 (e.g., morphine, hydromorphone).",
+        "confidence_score": 0.95
+    },
+    ("CODEINE", "RM"): {
+        "label": "Toxic",
+        "severity": "high",
+        "recommendation": "AVOID codeine. Ultra-rapid metabolizers have increased risk of life-threatening respiratory depression from rapid morphine formation. Use alternative analgesics.",
+        "confidence_score": 0.95
+    },
+    ("WARFARIN", "NM"): {
+        "label": "Adjust Dosage",
+        "severity": "moderate",
+        "recommendation": "Start with standard warfarin dosing (5mg/day). Monitor INR closely.",
+        "confidence_score": 0.80
+    },
+    ("WARFARIN", "PM"): {
+        "label": "Adjust Dosage",
+        "severity": "moderate",
+        "recommendation": "REDUCE warfarin dose. CYP2C9 poor/intermediate metabolizers require 30-50% lower starting doses. Use pharmacogenetic dosing algorithms. Monitor INR frequently.",
+        "confidence_score": 0.90
+    },
+    ("CLOPIDOGREL", "NM"): {
+        "label": "Safe",
+        "severity": "none",
+        "recommendation": "Use clopidogrel at standard dose (75mg/day).",
+        "confidence_score": 0.85
+    },
+    ("CLOPIDOGREL", "PM"): {
+        "label": "Ineffective",
+        "severity": "high",
+        "recommendation": "AVOID clopidogrel. Poor metabolizers have significantly reduced active metabolite formation. Use alternative antiplatelet therapy: prasugrel or ticagrelor at standard doses.",
+        "confidence_score": 0.95
+    },
+    ("CLOPIDOGREL", "IM"): {
+        "label": "Ineffective",
+        "severity": "moderate",
+        "recommendation": "CONSIDER ALTERNATIVE to clopidogrel. Intermediate metabolizers have reduced platelet inhibition. Prasugrel or ticagrelor may be more effective.",
+        "confidence_score": 0.85
+    },
+    ("SIMVASTATIN", "NM"): {
+        "label": "Safe",
+        "severity": "none",
+        "phenotype": "Normal function",
+        "recommendation": "Use simvastatin at standard dose (up to 40mg/day).",
+        "confidence_score": 0.85
+    },
+    ("SIMVASTATIN", "PM"): {
+        "label": "Toxic",
+        "severity": "high",
+        "phenotype": "Poor function",
+        "recommendation": "SIGNIFICANTLY REDUCE simvastatin dose or consider alternative statin. Homozygous SLCO1B1 variants have 200% higher statin exposure. Maximum recommended dose: 20mg/day with close monitoring for myopathy.",
+        "confidence_score": 0.95
+    },
+    ("SIMVASTATIN", "IM"): {
+        "label": "Adjust Dosage",
+        "severity": "moderate",
+        "phenotype": "Intermediate function",
+        "recommendation": "REDUCE simvastatin dose. Heterozygous SLCO1B1 variants have increased statin exposure. Maximum recommended dose: 40mg/day. Consider alternative statin (pravastatin, rosuvastatin) if higher doses needed.",
+        "confidence_score": 0.90
+    },
+    ("AZATHIOPRINE", "NM"): {
+        "label": "Safe",
+        "severity": "none",
+        "phenotype": "Normal metabolizer",
+        "recommendation": "Use azathioprine at standard dose (2-3 mg/kg/day).",
+        "confidence_score": 0.85
+    },
+    ("AZATHIOPRINE", "PM"): {
+        "label": "Toxic",
+        "severity": "critical",
+        "phenotype": "Poor metabolizer",
+        "recommendation": "AVOID azathioprine. TPMT poor metabolizers risk life-threatening myelosuppression. Use alternative immunosuppressants (e.g., cyclosporine, tacrolimus) or reduce dose by 90% with extreme caution and frequent monitoring.",
+        "confidence_score": 0.98
+    },
+    ("AZATHIOPRINE", "IM"): {
+        "label": "Adjust Dosage",
+        "severity": "high",
+        "phenotype": "Intermediate metabolizer",
+        "recommendation": "REDUCE azathioprine dose. TPMT intermediate metabolizers require 30-70% dose reduction. Start at 30-50% of standard dose and titrate based on tolerance and blood counts.",
+        "confidence_score": 0.90
+    },
+    ("FLUOROURACIL", "NM"): {
+        "label": "Safe",
+        "severity": "none",
+        "phenotype": "Normal metabolizer",
+        "recommendation": "Use fluorouracil at standard dose.",
+        "confidence_score": 0.85
+    },
+    ("FLUOROURACIL", "PM"): {
+        "label": "Toxic",
+        "severity": "critical",
+        "phenotype": "Poor metabolizer",
+        "recommendation": "AVOID fluorouracil. DPYD poor metabolizers risk severe, life-threatening toxicity including myelosuppression, neurotoxicity, and gastrointestinal toxicity. Use alternative chemotherapeutic agents.",
+        "confidence_score": 0.98
+    },
+    ("FLUOROURACIL", "IM"): {
+        "label": "Toxic",
+        "severity": "high",
+        "phenotype": "Intermediate metabolizer",
+        "recommendation": "REDUCE fluorouracil dose by 50%. DPYD intermediate metabolizers have increased risk of severe toxicity. Consider alternative chemotherapy or reduce dose with intensive monitoring.",
+        "confidence_score": 0.95
+    },
+}
+
+VKORC1_NOTE = " VKORC1 variant detected - consider 40-50% dose reduction."
+
+# Response for drugs without a CPIC rule set
+DEFAULT_RESPONSE = {
+    "label": "Unknown",
+    "severity": "unknown",
+    "phenotype": "Unknown",
+    "diplotype": "*1/*1",
+    "gene": "Unknown",
+    "recommendation": "Insufficient genetic data. Standard dosing recommended with clinical monitoring.",
+    "confidence_score": 0.5,
+    "cpic_level": "N/A"
+}
+
+class VariantKey(NamedTuple):
+    """Hashable view of the variant fields read by the drug rules"""
+    gene: str
+    rsid: str
+    allele: str
+    function: str
+    genotype: str
+
+def build_variant_key(variants: List[Variant]) -> Tuple[VariantKey, ...]:
+    """
+    Build the cache key for a patient's variants.
+    Kept as an ordered tuple because diplotype calling depends on variant order.
+    """
+    return tuple(
+        VariantKey(v.gene, v.rsid, v.allele, v.function, v.genotype)
+        for v in variants
+    )
+
+def get_clinical_risk(variants: List[Variant], drug: str,
+                      variant_key: Optional[Tuple[VariantKey, ...]] = None) -> Dict[str, Any]:
     """
     Determine clinical risk for a specific drug based on genetic variants.
     Returns complete risk assessment matching JSON schema.
+    drug must be the normalized (upper-case, stripped) name.
+    Pass a precomputed variant_key to reuse it across several drugs.
     """
-    drug = drug.upper().strip()
+    if drug not in _DISPATCH:
+        return dict(DEFAULT_RESPONSE)
     
-    # Default response (no variants found)
-    default_response = {
-        "label": "Unknown",
-        "severity": "unknown",
-        "phenotype": "Unknown",
-        "diplotype": "*1/*1",
-        "gene": "Unknown",
-        "recommendation": "Insufficient genetic data. Standard dosing recommended with clinical monitoring.",
-        "confidence_score": 0.5,
-        "cpic_level": "N/A"
-    }
+    if variant_key is None:
+        variant_key = build_variant_key(variants)
     
-    # Route to appropriate drug-specific function
-    if drug == "CODEINE":
-        return analyze_codeine(variants)
-    elif drug == "WARFARIN":
-        return analyze_warfarin(variants)
-    elif drug == "CLOPIDOGREL":
-        return analyze_clopidogrel(variants)
-    elif drug == "SIMVASTATIN":
-        return analyze_simvastatin(variants)
-    elif drug == "AZATHIOPRINE":
-        return analyze_azathioprine(variants)
-    elif drug == "FLUOROURACIL":
-        return analyze_fluorouracil(variants)
-    else:
-        return default_response
+    # Copy so callers can't mutate the cached result
+    return dict(_analyze_cached(drug, variant_key))
 
-def analyze_codeine(variants: List[Dict]) -> Dict[str, Any]:
-    """CYP2D6-guided codeine analysis"""
-    gene = "CYP2D6"
-    gene_variants = get_variants_by_gene(variants, gene)
-    diplotype = get_diplotype(variants, gene)
-    phenotype = get_phenotype(gene, diplotype)
-    
-    # Default response
-    result = {
-        "label": "Safe",
-        "severity": "none",
-        "phenotype": phenotype,
+@lru_cache(maxsize=1024)
+def _variant_table(variant_key: Tuple[VariantKey, ...]) -> VariantTable:
+    """Build the table (and its gene index) once, shared by all drugs"""
+    return VariantTable.from_rows(variant_key)
+
+@lru_cache(maxsize=4096)
+def _analyze_cached(drug: str, variant_key: Tuple[VariantKey, ...]) -> Dict[str, Any]:
+    """Run the drug rules once per (drug, variant signature)"""
+    return _DISPATCH[drug](_variant_table(variant_key))
+
+def _build_result(drug: str, category: str, gene: str, diplotype: str, phenotype: str = "Unknown") -> Dict[str, Any]:
+    """Assemble a risk assessment from the RECOMMENDATIONS table"""
+    outcome = RECOMMENDATIONS[(drug, category)]
+    return {
+        "label": outcome["label"],
+        "severity": outcome["severity"],
+        "phenotype": outcome.get("phenotype", phenotype),
         "diplotype": diplotype,
         "gene": gene,
-        "recommendation": "Use codeine with standard dosing.",
-        "confidence_score": 0.85,
+        "recommendation": outcome["recommendation"],
+        "confidence_score": outcome["confidence_score"],
         "cpic_level": "A"
     }
+
+def _first_called_dose(genotypes: Iterable[str]) -> int:
+    """Allele dose of the first heterozygous/homozygous genotype, 0 if none"""
+    return next((ALLELE_DOSE[gt] for gt in genotypes if gt in ALLELE_DOSE), 0)
+
+def analyze_codeine(table: VariantTable) -> Dict[str, Any]:
+    """CYP2D6-guided codeine analysis"""
+    gene = "CYP2D6"
+    gene_rows = table.select(gene)
+    diplotype = diplotype_from_calls(gene_rows.allele, gene_rows.genotype)
+    phenotype = get_phenotype(gene, diplotype)
     
     # Check for poor metabolizers
     if phenotype == "PM":
-        result.update({
-            "label": "Toxic",
-            "severity": "high",
-            "recommendation": "AVOID codeine. Poor metabolizers risk morphine toxicity. Use non-opioid analgesics or alternative opioids not dependent on CYP2D6 (e.g., morphine, hydromorphone).",
-            "confidence_score": 0.95
-        })
+        category = "PM"
     # Check for ultra-rapid metabolizers
     elif phenotype == "RM" or phenotype == "URM":
-        result.update({
-            "label": "Toxic",
-            "severity": "high",
-            "recommendation": "AVOID codeine. Ultra-rapid metabolizers have increased risk of life-threatening respiratory depression from rapid morphine formation. Use alternative analgesics.",
-            "confidence_score": 0.95
-        })
+        category = "RM"
+    else:
+        category = "NM"
     
-    return result
+    return _build_result("CODEINE", category, gene, diplotype, phenotype)
 
-def analyze_warfarin(variants: List[Dict]) -> Dict[str, Any]:
+def analyze_warfarin(table: VariantTable) -> Dict[str, Any]:
     """CYP2C9-guided warfarin analysis"""
     gene = "CYP2C9"
-    gene_variants = get_variants_by_gene(variants, gene)
-    diplotype = get_diplotype(variants, gene)
+    gene_rows = table.select(gene)
+    diplotype = diplotype_from_calls(gene_rows.allele, gene_rows.genotype)
     phenotype = get_phenotype(gene, diplotype)
     
     # Check for VKORC1 variant (important for warfarin)
-    vkorc1_variants = [v for v in variants if v["gene"] == "VKORC1" or v["rsid"] == "rs9923231"]
-    vkorc1_present = len(vkorc1_variants) > 0
-    
-    result = {
-        "label": "Adjust Dosage",
-        "severity": "moderate",
-        "phenotype": phenotype,
-        "diplotype": diplotype,
-        "gene": gene,
-        "recommendation": "Start with standard warfarin dosing (5mg/day). Monitor INR closely.",
-        "confidence_score": 0.80,
-        "cpic_level": "A"
-    }
+    vkorc1_present = "VKORC1" in table.gene_index or "rs9923231" in table.rsid_index
     
+    # Poor and intermediate metabolizers share the reduced-dose advice
     if phenotype == "PM" or "*2" in diplotype or "*3" in diplotype:
-        result.update({
-            "label": "Adjust Dosage",
-            "severity": "moderate",
-            "recommendation": "REDUCE warfarin dose. CYP2C9 poor/intermediate metabolizers require 30-50% lower starting doses. Use pharmacogenetic dosing algorithms. Monitor INR frequently.",
-            "confidence_score": 0.90
-        })
+        category = "PM"
+    else:
+        category = "NM"
     
+    result = _build_result("WARFARIN", category, gene, diplotype, phenotype)
     if vkorc1_present:
-        result["recommendation"] += " VKORC1 variant detected - consider 40-50% dose reduction."
+        result["recommendation"] += VKORC1_NOTE
     
     return result
 
-def analyze_clopidogrel(variants: List[Dict]) -> Dict[str, Any]:
+def analyze_clopidogrel(table: VariantTable) -> Dict[str, Any]:
     """CYP2C19-guided clopidogrel analysis"""
     gene = "CYP2C19"
-    gene_variants = get_variants_by_gene(variants, gene)
-    diplotype = get_diplotype(variants, gene)
+    gene_rows = table.select(gene)
+    diplotype = diplotype_from_calls(gene_rows.allele, gene_rows.genotype)
     phenotype = get_phenotype(gene, diplotype)
     
-    result = {
-        "label": "Safe",
-        "severity": "none",
-        "phenotype": phenotype,
-        "diplotype": diplotype,
-        "gene": gene,
-        "recommendation": "Use clopidogrel at standard dose (75mg/day).",
-        "confidence_score": 0.85,
-        "cpic_level": "A"
-    }
-    
     # Check for *2 or *3 variants (loss of function)
-    if phenotype == "PM":
-        result.update({
-            "label": "Ineffective",
-            "severity": "high",
-            "recommendation": "AVOID clopidogrel. Poor metabolizers have significantly reduced active metabolite formation. Use alternative antiplatelet therapy: prasugrel or ticagrelor at standard doses.",
-            "confidence_score": 0.95
-        })
-    elif phenotype == "IM":
-        result.update({
-            "label": "Ineffective",
-            "severity": "moderate",
-            "recommendation": "CONSIDER ALTERNATIVE to clopidogrel. Intermediate metabolizers have reduced platelet inhibition. Prasugrel or ticagrelor may be more effective.",
-            "confidence_score": 0.85
-        })
+    category = phenotype if phenotype in ("PM", "IM") else "NM"
     
-    return result
+    return _build_result("CLOPIDOGREL", category, gene, diplotype, phenotype)
 
-def analyze_simvastatin(variants: List[Dict]) -> Dict[str, Any]:
+def analyze_simvastatin(table: VariantTable) -> Dict[str, Any]:
     """SLCO1B1-guided simvastatin analysis"""
     gene = "SLCO1B1"
-    gene_variants = get_variants_by_gene(variants, gene)
-    diplotype = get_diplotype(variants, gene)
+    gene_rows = table.select(gene)
+    diplotype = diplotype_from_calls(gene_rows.allele, gene_rows.genotype)
     
-    # SLCO1B1 phenotype is different - we need custom logic
-    phenotype = "Normal function"
-    risk_level = "low"
+    # SLCO1B1 phenotype is different - scored from the *5 variant (rs4149056)
+    dose = _first_called_dose(
+        genotype for allele, rsid, genotype in zip(gene_rows.allele, gene_rows.rsid, gene_rows.genotype)
+        if allele == "*5" or rsid == "rs4149056"
+    )
     
-    # Check for *5 variant (rs4149056)
-    c521t_variants = [v for v in gene_variants if v["allele"] == "*5" or v["rsid"] == "rs4149056"]
-    
-    result = {
-        "label": "Safe",
-        "severity": "none",
-        "phenotype": "Normal function",
-        "diplotype": diplotype,
-        "gene": gene,
-        "recommendation": "Use simvastatin at standard dose (up to 40mg/day).",
-        "confidence_score": 0.85,
-        "cpic_level": "A"
-    }
-    
-    if c521t_variants:
-        for v in c521t_variants:
-            if v["genotype"] in ["1/1", "1|1"]:  # Homozygous
-                result.update({
-                    "label": "Toxic",
-                    "severity": "high",
-                    "phenotype": "Poor function",
-                    "recommendation": "SIGNIFICANTLY REDUCE simvastatin dose or consider alternative statin. Homozygous SLCO1B1 variants have 200% higher statin exposure. Maximum recommended dose: 20mg/day with close monitoring for myopathy.",
-                    "confidence_score": 0.95
-                })
-                break
-            elif v["genotype"] in ["0/1", "1/0", "0|1", "1|0"]:  # Heterozygous
-                result.update({
-                    "label": "Adjust Dosage",
-                    "severity": "moderate",
-                    "phenotype": "Intermediate function",
-                    "recommendation": "REDUCE simvastatin dose. Heterozygous SLCO1B1 variants have increased statin exposure. Maximum recommended dose: 40mg/day. Consider alternative statin (pravastatin, rosuvastatin) if higher doses needed.",
-                    "confidence_score": 0.90
-                })
-                break
-    
-    return result
+    return _build_result("SIMVASTATIN", DOSE_CATEGORY[dose], gene, diplotype)
 
-def analyze_azathioprine(variants: List[Dict]) -> Dict[str, Any]:
+def analyze_azathioprine(table: VariantTable) -> Dict[str, Any]:
     """TPMT-guided azathioprine analysis"""
     gene = "TPMT"
-    gene_variants = get_variants_by_gene(variants, gene)
-    diplotype = get_diplotype(variants, gene)
-    
-    result = {
-        "label": "Safe",
-        "severity": "none",
-        "phenotype": "Normal metabolizer",
-        "diplotype": diplotype,
-        "gene": gene,
-        "recommendation": "Use azathioprine at standard dose (2-3 mg/kg/day).",
-        "confidence_score": 0.85,
-        "cpic_level": "A"
-    }
+    gene_rows = table.select(gene)
+    diplotype = diplotype_from_calls(gene_rows.allele, gene_rows.genotype)
     
-    # Count variant alleles
-    variant_count = 0
-    for v in gene_variants:
-        if v["genotype"] in ["1/1", "1|1"]:
-            variant_count += 2
-        elif v["genotype"] in ["0/1", "1/0", "0|1", "1|0"]:
-            variant_count += 1
+    # Count variant alleles across all TPMT variants
+    variant_count = sum(ALLELE_DOSE.get(genotype, 0) for genotype in gene_rows.genotype)
     
-    if variant_count == 2:  # Two variant alleles
-        result.update({
-            "label": "Toxic",
-            "severity": "critical",
-            "phenotype": "Poor metabolizer",
-            "recommendation": "AVOID azathioprine. TPMT poor metabolizers risk life-threatening myelosuppression. Use alternative immunosuppressants (e.g., cyclosporine, tacrolimus) or reduce dose by 90% with extreme caution and frequent monitoring.",
-            "confidence_score": 0.98
-        })
-    elif variant_count == 1:  # One variant allele
-        result.update({
-            "label": "Adjust Dosage",
-            "severity": "high",
-            "phenotype": "Intermediate metabolizer",
-            "recommendation": "REDUCE azathioprine dose. TPMT intermediate metabolizers require 30-70% dose reduction. Start at 30-50% of standard dose and titrate based on tolerance and blood counts.",
-            "confidence_score": 0.90
-        })
-    
-    return result
+    return _build_result("AZATHIOPRINE", DOSE_CATEGORY.get(variant_count, "NM"), gene, diplotype)
 
-def analyze_fluorouracil(variants: List[Dict]) -> Dict[str, Any]:
+def analyze_fluorouracil(table: VariantTable) -> Dict[str, Any]:
     """DPYD-guided fluorouracil analysis"""
     gene = "DPYD"
-    gene_variants = get_variants_by_gene(variants, gene)
-    diplotype = get_diplotype(variants, gene)
+    gene_rows = table.select(gene)
+    diplotype = diplotype_from_calls(gene_rows.allele, gene_rows.genotype)
     
-    result = {
-        "label": "Safe",
-        "severity": "none",
-        "phenotype": "Normal metabolizer",
-        "diplotype": diplotype,
-        "gene": gene,
-        "recommendation": "Use fluorouracil at standard dose.",
-        "confidence_score": 0.85,
-        "cpic_level": "A"
-    }
+    # Check for high-risk / loss-of-function DPYD variants
+    dose = _first_called_dose(
+        genotype for allele, function, genotype in zip(gene_rows.allele, gene_rows.function, gene_rows.genotype)
+        if allele in HIGH_RISK_DPYD or function == "Loss of function"
+    )
     
-    # Check for DPYD variants
-    high_risk_variants = ["*2A", "*13", "HapB3"]
-    
-    for v in gene_variants:
-        if v["allele"] in high_risk_variants or v["function"] == "Loss of function":
-            if v["genotype"] in ["1/1", "1|1"]:  # Homozygous
-                result.update({
-                    "label": "Toxic",
-                    "severity": "critical",
-                    "phenotype": "Poor metabolizer",
-                    "recommendation": "AVOID fluorouracil. DPYD poor metabolizers risk severe, life-threatening toxicity including myelosuppression, neurotoxicity, and gastrointestinal toxicity. Use alternative chemotherapeutic agents.",
-                    "confidence_score": 0.98
-                })
-                break
-            elif v["genotype"] in ["0/1", "1/0", "0|1", "1|0"]:  # Heterozygous
-                result.update({
-                    "label": "Toxic",
-                    "severity": "high",
-                    "phenotype": "Intermediate metabolizer",
-                    "recommendation": "REDUCE fluorouracil dose by 50%. DPYD intermediate metabolizers have increased risk of severe toxicity. Consider alternative chemotherapy or reduce dose with intensive monitoring.",
-                    "confidence_score": 0.95
-                })
-                break
-    
-    return result
\ No newline at end of file
+    return _build_result("FLUOROURACIL", DOSE_CATEGORY[dose], gene, diplotype)
+
+# Drug name -> rule set. Add new drugs here.
+_DISPATCH = {
+    "CODEINE": analyze_codeine,
+    "WARFARIN": analyze_warfarin,
+    "CLOPIDOGREL": analyze_clopidogrel,
+    "SIMVASTATIN": analyze_simvastatin,
+    "AZATHIOPRINE": analyze_azathioprine,
+    "FLUOROURACIL": analyze_fluorouracil,
+}
\ No newline at end of file
@@ -1,22 +1,191 @@
+import asyncio
 import os
-import requests
+import re
+import time
+import hashlib
+import httpx
 import json
+from collections import OrderedDict
 from dotenv import load_dotenv
 
 load_dotenv()
 
-def get_explanation(drug, phenotype, variants):
-    api_key = os.getenv("GEMINI_API_KEY")
+# Shared client so Gemini calls reuse one pooled HTTP/2 connection.
+# Created per app lifespan (see open_client) since it is bound to the event loop.
+_client = None
+
+# Prompt templates, formatted per request
+_EXPLANATION_PROMPT = (
+    "Act as a clinical pharmacologist. Explain why a patient "
+    "with a {phenotype} phenotype has altered risk for {drug}. "
+    "Provide the response strictly as a raw JSON object with exactly two keys: "
+    "'summary' (1 sentence) and 'mechanism' (brief biological explanation). "
+    "Do not include any markdown formatting, backticks, or extra text. Just the JSON."
+)
+_BATCH_PROMPT = (
+    "Act as a clinical pharmacologist. For each of the following (drug, phenotype) pairs, "
+    "explain why a patient with that phenotype has altered risk for that drug.\n"
+    "{pairs}\n"
+    "Provide the response strictly as a raw JSON array with one object per pair, each with "
+    "exactly four keys: 'drug' (as given), 'phenotype' (as given), 'summary' (1 sentence) "
+    "and 'mechanism' (brief biological explanation). "
+    "Do not include any markdown formatting, backticks, or extra text. Just the JSON."
+)
+
+# Optional markdown code fences the model sometimes wraps its JSON in
+_FENCE_RE = re.compile(r"^\s*(?:```(?:json)?)?\s*(.*?)\s*(?:```)?\s*$", re.DOTALL)
+
+# Discovered model per API key: sha256(key) -> (model name, discovered at)
+_MODEL_CACHE = {}
+_MODEL_CACHE_TTL = 3600  # seconds
+
+# LLM explanations keyed by (drug, phenotype) - the only inputs to the prompt
+_EXPLANATION_CACHE = OrderedDict()
+_EXPLANATION_CACHE_SIZE = 64
+
+# Upper bound on in-flight Gemini generate calls, to stay under the API's QPS limit
+LLM_MAX_CONCURRENCY = 16
+_llm_slots = None  # Created with the client, for the same event loop
+
+def open_client():
+    """Create the shared Gemini client and concurrency limit for the running event loop"""
+    global _client, _llm_slots
+    _client = httpx.AsyncClient(
+        http2=True,
+        base_url="https://generativelanguage.googleapis.com",
+        timeout=30.0
+    )
+    _llm_slots = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+
+async def close_client():
+    global _client, _llm_slots
+    if _client is not None:
+        await _client.aclose()
+    _client = None
+    _llm_slots = None
+
+def _get_client():
+    # Callers outside the app lifespan (scripts, tests) get one on demand
+    if _client is None or _client.is_closed:
+        open_client()
+    return _client
+
+async def get_explanation(drug, phenotype, variants, use_cache=True):
+    # variants is kept for API compatibility; the prompt doesn't use it
+    key = (drug, phenotype)
+    if use_cache and key in _EXPLANATION_CACHE:
+        _EXPLANATION_CACHE.move_to_end(key)
+        return dict(_EXPLANATION_CACHE[key])
+    return await _generate_explanation(drug, phenotype)
+
+def _remember_explanation(drug, phenotype, explanation):
+    _EXPLANATION_CACHE[(drug, phenotype)] = explanation
+    _EXPLANATION_CACHE.move_to_end((drug, phenotype))
+    if len(_EXPLANATION_CACHE) > _EXPLANATION_CACHE_SIZE:
+        _EXPLANATION_CACHE.popitem(last=False)
+
+async def _generate_explanation(drug, phenotype):
+    api_key = _get_api_key()
     if not api_key:
         return get_fallback(phenotype, "Missing API Key")
     
-    api_key = api_key.strip().replace('"', '').replace("'", "")
-    host = "https://generativelanguage.googleapis.com"
+    # --- STEP 1: AUTO-DISCOVER AVAILABLE MODELS (cached per key) ---
+    target_model = await _discover_model(api_key)
+    if not target_model:
+        return get_fallback(phenotype, "API Key has no access to any generative models.")
+        
+    # --- STEP 2: GENERATE THE EXPLANATION ---
+    prompt = _EXPLANATION_PROMPT.format(drug=drug, phenotype=phenotype)
+    
+    try:
+        content_str = await _generate_content(api_key, target_model, prompt)
+        reply = json.loads(_strip_markdown(content_str))
+    except Exception as e:
+        print(f"LLM Python Error: {str(e)}")
+        return get_fallback(phenotype, str(e))
+    
+    # Only well-formed generations are cached; anything else falls back and is retried
+    if not isinstance(reply, dict) or "summary" not in reply or "mechanism" not in reply:
+        return get_fallback(phenotype, "Malformed LLM response")
+    explanation = {"summary": reply["summary"], "mechanism": reply["mechanism"]}
+    _remember_explanation(drug, phenotype, explanation)
+    return dict(explanation)
+
+async def get_explanations_batch(drug_phenotype_pairs, use_cache=True):
+    """
+    Explain several (drug, phenotype) pairs with a single Gemini call.
+    Returns {(drug, phenotype): {"summary": ..., "mechanism": ...}}, one entry
+    per distinct pair. Cached pairs are served locally and only the rest are
+    sent to the model.
+    """
+    explanations = {}
+    missing = []
+    for pair in dict.fromkeys(drug_phenotype_pairs):
+        if use_cache and pair in _EXPLANATION_CACHE:
+            _EXPLANATION_CACHE.move_to_end(pair)
+            explanations[pair] = dict(_EXPLANATION_CACHE[pair])
+        else:
+            missing.append(pair)
+    
+    if not missing:
+        return explanations
+    
+    api_key = _get_api_key()
+    if not api_key:
+        return _fill_fallbacks(explanations, missing, "Missing API Key")
+    
+    target_model = await _discover_model(api_key)
+    if not target_model:
+        return _fill_fallbacks(explanations, missing, "API Key has no access to any generative models.")
+    
+    pairs_text = "\n".join(f"- drug: {drug}, phenotype: {phenotype}" for drug, phenotype in missing)
+    prompt = _BATCH_PROMPT.format(pairs=pairs_text)
     
-    # --- STEP 1: AUTO-DISCOVER AVAILABLE MODELS ---
     try:
-        models_url = f"{host}/v1beta/models?key={api_key}"
-        models_res = requests.get(models_url)
+        content_str = await _generate_content(api_key, target_model, prompt)
+        items = json.loads(_strip_markdown(content_str))
+        by_pair = {
+            (str(item.get("drug", "")).upper(), str(item.get("phenotype", ""))): item
+            for item in items if isinstance(item, dict)
+        }
+    except Exception as e:
+        print(f"LLM Python Error: {str(e)}")
+        return _fill_fallbacks(explanations, missing, str(e))
+    
+    for drug, phenotype in missing:
+        item = by_pair.get((drug.upper(), str(phenotype)))
+        if item is None or "summary" not in item or "mechanism" not in item:
+            explanations[(drug, phenotype)] = get_fallback(phenotype, "Missing from batch response")
+            continue
+        explanation = {"summary": item["summary"], "mechanism": item["mechanism"]}
+        _remember_explanation(drug, phenotype, explanation)
+        explanations[(drug, phenotype)] = dict(explanation)
+    
+    return explanations
+
+def _fill_fallbacks(explanations, pairs, error_msg):
+    for drug, phenotype in pairs:
+        explanations[(drug, phenotype)] = get_fallback(phenotype, error_msg)
+    return explanations
+
+def _get_api_key():
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        return None
+    return api_key.strip().replace('"', '').replace("'", "")
+
+async def _discover_model(api_key):
+    """
+    Pick a generative model for this key, cached for _MODEL_CACHE_TTL.
+    Returns None if the key has no access to any generative model.
+    """
+    cache_key = hashlib.sha256(api_key.encode()).hexdigest()
+    cached = _MODEL_CACHE.get(cache_key)
+    if cached and time.monotonic() - cached[1] < _MODEL_CACHE_TTL:
+        return cached[0]
+    
+    try:
+        models_res = await _get_client().get("/v1beta/models", params={"key": api_key})
         models_data = models_res.json()
         
         # Find all models that this specific API key is allowed to use for text generation
@@ -26,53 +195,42 @@ def get_explanation(drug, phenotype, variants):
         ]
         
         if not valid_models:
-            return get_fallback(phenotype, "API Key has no access to any generative models.")
+            return None
             
         # Prefer a 'flash' model for speed, otherwise just use the first available one
         target_model = next((m for m in valid_models if 'flash' in m), valid_models[0])
+        _MODEL_CACHE[cache_key] = (target_model, time.monotonic())
         print(f"SUCCESS: Auto-selected model -> {target_model}")
+        return target_model
         
     except Exception as e:
         print(f"Failed to auto-discover models: {e}")
-        # Absolute newest fallback if discovery fails
-        target_model = "models/gemini-2.0-flash" 
-        
-    # --- STEP 2: GENERATE THE EXPLANATION ---
-    url = f"{host}/v1beta/{target_model}:generateContent?key={api_key}"
-    
-    prompt = (
-        f"Act as a clinical pharmacologist. Explain why a patient "
-        f"with a {phenotype} phenotype has altered risk for {drug}. "
-        f"Provide the response strictly as a raw JSON object with exactly two keys: "
-        f"'summary' (1 sentence) and 'mechanism' (brief biological explanation). "
-        f"Do not include any markdown formatting, backticks, or extra text. Just the JSON."
-    )
-    
+        # Absolute newest fallback if discovery fails (not cached, retried next call)
+        return "models/gemini-2.0-flash"
+
+async def _generate_content(api_key, target_model, prompt):
+    """Send one prompt to Gemini and return the raw response text"""
     payload = {
         "contents": [{"parts": [{"text": prompt}]}]
     }
+    client = _get_client()
+    async with _llm_slots:
+        response = await client.post(
+            f"/v1beta/{target_model}:generateContent",
+            params={"key": api_key},
+            json=payload
+        )
     
-    try:
-        response = requests.post(url, json=payload)
-        
-        if response.status_code != 200:
-            print(f"API Error {response.status_code}: {response.text}")
-            return get_fallback(phenotype, f"Google API Error {response.status_code}")
-            
-        data = response.json()
-        content_str = data['candidates'][0]['content']['parts'][0]['text']
+    if response.status_code != 200:
+        print(f"API Error {response.status_code}: {response.text}")
+        raise RuntimeError(f"Google API Error {response.status_code}")
         
-        # Clean markdown if the AI disobeys instructions
-        clean_json = content_str.strip()
-        if clean_json.startswith("```json"): clean_json = clean_json[7:]
-        if clean_json.startswith("```"): clean_json = clean_json[3:]
-        if clean_json.endswith("```"): clean_json = clean_json[:-3]
-            
-        return json.loads(clean_json.strip())
-        
-    except Exception as e:
-        print(f"LLM Python Error: {str(e)}")
-        return get_fallback(phenotype, str(e))
+    data = response.json()
+    return data['candidates'][0]['content']['parts'][0]['text']
+
+def _strip_markdown(content_str):
+    # Clean markdown if the AI disobeys instructions
+    return _FENCE_RE.match(content_str).group(1)
 
 def get_fallback(phenotype, error_msg):
     print(f"Fallback triggered due to: {error_msg}")
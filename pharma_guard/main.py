@@ -1,16 +1,27 @@
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
-import os
+from contextlib import asynccontextmanager
+import asyncio
+import io
+import operator
 import traceback
 import datetime
 import uuid
-from typing import List, Optional
-from parser import parse_vcf_file, TARGET_VARIANTS, DRUG_GENE_MAP
-from engine import get_clinical_risk, CPIC_GUIDELINES
-from llm import get_explanation
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+from parser import Variant, parse_vcf_stream, TARGET_VARIANTS, DRUG_GENE_MAP
+from engine import get_clinical_risk, build_variant_key, CPIC_GUIDELINES
+from llm import get_explanation, get_explanations_batch, get_fallback, open_client, close_client
 
-app = FastAPI(title="PharmaGuard API", description="Pharmacogenomic Risk Prediction System", version="2.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The shared Gemini HTTP client lives for one startup/shutdown cycle
+    open_client()
+    yield
+    await close_client()
+
+app = FastAPI(title="PharmaGuard API", description="Pharmacogenomic Risk Prediction System", version="2.0", lifespan=lifespan)
 
 # Configure CORS
 app.add_middleware(
@@ -21,11 +32,26 @@ app.add_middleware(
     allow_credentials=True,
 )
 
-# Ensure upload directory exists
-UPLOAD_DIR = "uploads"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+MAX_UPLOAD_BYTES = 5 * 1024 * 1024  # 5MB limit as per PS
+# Decompressed size cap for .vcf.gz uploads, so a small gzip bomb can't
+# tie up a worker (the 5MB limit only bounds the compressed bytes)
+MAX_DECOMPRESSED_BYTES = 50 * MAX_UPLOAD_BYTES
+UPLOAD_CHUNK_BYTES = 64 * 1024
+MAX_BATCH_DRUGS = 10  # Distinct drug names per /analyze/batch request
+
+# Variant fields reported per detected variant
+_DETECTED_VARIANT_KEYS = ("rsid", "gene", "allele", "function", "genotype", "chromosome", "position", "cpic_level")
+_VARIANT_FIELDS = operator.attrgetter(*_DETECTED_VARIANT_KEYS)
+
+# Declared response model: FastAPI then serializes straight to JSON bytes
+# in pydantic-core instead of running jsonable_encoder in Python
+JSONObject = Dict[str, Any]
 
-@app.get("/")
+@lru_cache(maxsize=4096)
+def _dbsnp_url(rsid: str) -> str:
+    return f"https://www.ncbi.nlm.nih.gov/snp/{rsid}"
+
+@app.get("/", response_model=JSONObject)
 async def root():
     return {
         "service": "PharmaGuard API",
@@ -36,11 +62,11 @@ async def root():
         "cpic_guidelines": CPIC_GUIDELINES
     }
 
-@app.get("/health")
+@app.get("/health", response_model=JSONObject)
 async def health_check():
     return {"status": "healthy", "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat()}
 
-@app.post("/analyze")
+@app.post("/analyze", response_model=JSONObject)
 async def analyze(
     drug: str = Form(...),
     vcf: UploadFile = File(...),
@@ -51,155 +77,189 @@ async def analyze(
     Returns complete JSON schema as required by RIFT 2026.
     """
     try:
-        # Validate file type
-        if not vcf.filename.endswith('.vcf'):
-            raise HTTPException(status_code=400, detail="File must be a .vcf file")
+        # Normalize the drug name once; everything downstream uses this form
+        drug = drug.upper().strip()
         
         # Generate patient ID if not provided
         if not patient_id:
             patient_id = f"PATIENT_{uuid.uuid4().hex[:8].upper()}"
         
-        # Save uploaded file
-        file_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4()}_{vcf.filename}")
-        try:
-            content = await vcf.read()
+        variants, parsing_success, file_size_bytes = await _read_vcf_upload(vcf)
+        return await _analyze_core(variants, drug, patient_id, vcf.filename, file_size_bytes, parsing_success)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        return _internal_error_response(e)
+
+async def _read_vcf_upload(vcf: UploadFile) -> tuple:
+    """
+    Validate, read and parse an uploaded VCF file in memory.
+    Returns (variants, parsing_success, file_size_bytes).
+    """
+    # Validate file type (bgzipped VCFs are decompressed by the parser)
+    if not vcf.filename.endswith(('.vcf', '.vcf.gz')):
+        raise HTTPException(status_code=400, detail="File must be a .vcf or .vcf.gz file")
+    
+    # Read uploaded file chunk by chunk (no temp file on disk)
+    buffer = io.BytesIO()
+    file_size_bytes = 0
+    try:
+        while chunk := await vcf.read(UPLOAD_CHUNK_BYTES):
+            file_size_bytes += len(chunk)
             
             # Check file size (5MB limit as per PS)
-            if len(content) > 5 * 1024 * 1024:
+            if file_size_bytes > MAX_UPLOAD_BYTES:
                 raise HTTPException(status_code=400, detail="File size exceeds 5MB limit")
             
-            with open(file_path, "wb") as buffer:
-                buffer.write(content)
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error saving file: {str(e)}")
+            buffer.write(chunk)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error reading file: {str(e)}")
 
-        # Step 1: Parse VCF file
-        try:
-            variants = parse_vcf_file(file_path)
-            parsing_success = True
-            variants_count = len(variants)
-        except Exception as e:
-            variants = []
-            parsing_success = False
-            variants_count = 0
-            print(f"Parsing error: {traceback.format_exc()}")
+    # Step 1: Parse VCF file (CPU work - keep it off the event loop)
+    try:
+        buffer.seek(0)
+        variants = await asyncio.to_thread(parse_vcf_stream, buffer, MAX_DECOMPRESSED_BYTES)
+        parsing_success = True
+    except Exception as e:
+        variants = []
+        parsing_success = False
+        print(f"Parsing error: {traceback.format_exc()}")
+    
+    return variants, parsing_success, file_size_bytes
 
-        # Step 2: Get clinical risk assessment
-        try:
-            risk = get_clinical_risk(variants, drug)
-        except Exception as e:
-            risk = {
-                "label": "Unknown",
-                "severity": "unknown",
-                "phenotype": "Unknown",
-                "diplotype": "*1/*1",
-                "gene": "Unknown",
-                "recommendation": "Error in risk assessment. Please try again.",
-                "confidence_score": 0.0,
-                "cpic_level": "N/A"
-            }
-            print(f"Risk engine error: {traceback.format_exc()}")
+def _assess_risk(variants: List[Variant], drug: str, variant_key: tuple) -> dict:
+    """Clinical risk for one drug, or a placeholder result if the engine fails"""
+    try:
+        return get_clinical_risk(variants, drug, variant_key)
+    except Exception as e:
+        print(f"Risk engine error: {traceback.format_exc()}")
+        return {
+            "label": "Unknown",
+            "severity": "unknown",
+            "phenotype": "Unknown",
+            "diplotype": "*1/*1",
+            "gene": "Unknown",
+            "recommendation": "Error in risk assessment. Please try again.",
+            "confidence_score": 0.0,
+            "cpic_level": "N/A"
+        }
+
+def _explanation_unavailable(drug: str, phenotype: str) -> dict:
+    print(f"LLM error: {traceback.format_exc()}")
+    return {
+        "summary": f"Patient exhibits {phenotype} phenotype for {drug}.",
+        "mechanism": "LLM explanation temporarily unavailable. Please refer to CPIC guidelines."
+    }
 
-        # Step 3: Get LLM explanation
+async def _analyze_core(variants: List[Variant], drug: str, patient_id: str, filename: str,
+                        file_size_bytes: int, parsing_success: bool = True,
+                        variant_key: Optional[tuple] = None, risk: Optional[dict] = None,
+                        explanation: Optional[dict] = None) -> dict:
+    """
+    Build the full analysis response for one drug from already-parsed variants.
+    drug must already be normalized (upper-case, stripped). Callers that have
+    already computed the risk or LLM explanation (the batch endpoint) pass them in.
+    """
+    # Step 2: Get clinical risk assessment
+    if variant_key is None:
+        variant_key = build_variant_key(variants)
+    if risk is None:
+        risk = _assess_risk(variants, drug, variant_key)
+
+    # Step 3: Start the full panel, then get LLM explanation while it runs
+    panel_task = asyncio.create_task(get_comprehensive_risk(variants, drug, variant_key))
+    if explanation is None:
         try:
-            explanation = get_explanation(drug, risk['phenotype'], variants)
+            explanation = await get_explanation(drug, risk['phenotype'], variants)
         except Exception as e:
-            explanation = {
-                "summary": f"Patient exhibits {risk['phenotype']} phenotype for {drug}.",
-                "mechanism": "LLM explanation temporarily unavailable. Please refer to CPIC guidelines."
-            }
-            print(f"LLM error: {traceback.format_exc()}")
+            explanation = _explanation_unavailable(drug, risk['phenotype'])
 
-        # Step 4: Clean up uploaded file (optional - can keep for debugging)
-        try:
-            os.remove(file_path)
-        except:
-            pass
-
-        # Step 5: Build complete JSON response matching required schema
-        response = {
-            "patient_id": patient_id,
-            "drug": drug.upper(),
-            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
-            "risk_assessment": {
-                "risk_label": risk.get("label", "Unknown"),
-                "confidence_score": risk.get("confidence_score", 0.5),
-                "severity": risk.get("severity", "unknown")
-            },
-            "pharmacogenomic_profile": {
-                "primary_gene": risk.get("gene", "Unknown"),
-                "diplotype": risk.get("diplotype", "*1/*1"),
-                "phenotype": risk.get("phenotype", "Unknown"),
-                "detected_variants": [
-                    {
-                        "rsid": v["rsid"],
-                        "gene": v["gene"],
-                        "allele": v.get("allele", "Unknown"),
-                        "function": v.get("function", "Unknown"),
-                        "genotype": v["genotype"],
-                        "chromosome": v["chromosome"],
-                        "position": v["position"],
-                        "cpic_level": v.get("cpic_level", "N/A")
-                    } for v in variants
-                ]
-            },
-            "clinical_recommendation": {
-                "action": risk.get("recommendation", "Insufficient data for recommendation."),
-                "guideline_source": CPIC_GUIDELINES.get(drug.upper(), "CPIC (Clinical Pharmacogenetics Implementation Consortium)"),
-                "cpic_evidence_level": risk.get("cpic_level", "N/A"),
-                "requires_physician_review": True
-            },
-            "llm_generated_explanation": {
-                "summary": explanation.get("summary", ""),
-                "mechanism": explanation.get("mechanism", ""),
-                "citations": [
-                    {
-                        "rsid": v["rsid"],
-                        "gene": v["gene"],
-                        "dbSNP_url": f"https://www.ncbi.nlm.nih.gov/snp/{v['rsid']}"
-                    } for v in variants[:5]  # Limit to 5 citations
-                ]
-            },
-            "quality_metrics": {
-                "vcf_parsing_success": parsing_success,
-                "total_variants_analyzed": variants_count,
-                "variants_detected": len(variants),
-                "file_name": vcf.filename,
-                "file_size_bytes": len(content)
-            },
-            "comprehensive_panel": await get_comprehensive_risk(variants, drug)
-        }
+    comprehensive_panel = await panel_task
 
-        return response
+    # Step 4: Build complete JSON response matching required schema
+    response = {
+        "patient_id": patient_id,
+        "drug": drug,
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "risk_assessment": {
+            "risk_label": risk.get("label", "Unknown"),
+            "confidence_score": risk.get("confidence_score", 0.5),
+            "severity": risk.get("severity", "unknown")
+        },
+        "pharmacogenomic_profile": {
+            "primary_gene": risk.get("gene", "Unknown"),
+            "diplotype": risk.get("diplotype", "*1/*1"),
+            "phenotype": risk.get("phenotype", "Unknown"),
+            "detected_variants": [
+                dict(zip(_DETECTED_VARIANT_KEYS, _VARIANT_FIELDS(v))) for v in variants
+            ]
+        },
+        "clinical_recommendation": {
+            "action": risk.get("recommendation", "Insufficient data for recommendation."),
+            "guideline_source": CPIC_GUIDELINES.get(drug, "CPIC (Clinical Pharmacogenetics Implementation Consortium)"),
+            "cpic_evidence_level": risk.get("cpic_level", "N/A"),
+            "requires_physician_review": True
+        },
+        "llm_generated_explanation": {
+            "summary": explanation.get("summary", ""),
+            "mechanism": explanation.get("mechanism", ""),
+            "citations": [
+                {
+                    "rsid": v.rsid,
+                    "gene": v.gene,
+                    "dbSNP_url": _dbsnp_url(v.rsid)
+                } for v in variants[:5]  # Limit to 5 citations
+            ]
+        },
+        "quality_metrics": {
+            "vcf_parsing_success": parsing_success,
+            "total_variants_analyzed": len(variants),
+            "variants_detected": len(variants),
+            "file_name": filename,
+            "file_size_bytes": file_size_bytes
+        },
+        "comprehensive_panel": comprehensive_panel
+    }
 
-    except HTTPException:
-        raise
-    except Exception as e:
-        print("CRITICAL ERROR IN API:")
-        print(traceback.format_exc())
-        return JSONResponse(
-            status_code=500,
-            content={
-                "error": "Internal server error",
-                "detail": str(e),
-                "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat()
-            }
-        )
+    return response
+
+def _internal_error_response(e: Exception) -> JSONResponse:
+    print("CRITICAL ERROR IN API:")
+    print(traceback.format_exc())
+    return JSONResponse(
+        status_code=500,
+        content={
+            "error": "Internal server error",
+            "detail": str(e),
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat()
+        }
+    )
 
-async def get_comprehensive_risk(variants: List[dict], primary_drug: str) -> dict:
+async def get_comprehensive_risk(variants: List[Variant], primary_drug: str, variant_key: Optional[tuple] = None) -> dict:
     """
     Generate risk assessment for all 6 drugs (full panel screening)
     This runs silently in the background
+    primary_drug must already be normalized (upper-case, stripped).
     """
+    if variant_key is None:
+        variant_key = build_variant_key(variants)
+    
     all_drugs = ["CODEINE", "WARFARIN", "CLOPIDOGREL", "SIMVASTATIN", "AZATHIOPRINE", "FLUOROURACIL"]
+    # Skip the primary drug (already analyzed)
+    panel_drugs = [d for d in all_drugs if d != primary_drug]
     panel = {}
     
-    for drug in all_drugs:
-        if drug == primary_drug.upper():
-            continue  # Skip the primary drug (already analyzed)
-        
-        try:
-            risk = get_clinical_risk(variants, drug)
+    # Rule evaluation is CPU work - keep it off the event loop
+    results = await asyncio.gather(
+        *(asyncio.to_thread(get_clinical_risk, variants, d, variant_key) for d in panel_drugs),
+        return_exceptions=True
+    )
+    
+    for drug, risk in zip(panel_drugs, results):
+        if not isinstance(risk, BaseException):
             panel[drug] = {
                 "risk_label": risk.get("label", "Unknown"),
                 "severity": risk.get("severity", "unknown"),
@@ -207,7 +267,7 @@ async def get_comprehensive_risk(variants: List[dict], primary_drug: str) -> dic
                 "phenotype": risk.get("phenotype", "Unknown"),
                 "confidence_score": risk.get("confidence_score", 0.5)
             }
-        except:
+        else:
             panel[drug] = {
                 "risk_label": "Error",
                 "severity": "unknown",
@@ -218,31 +278,57 @@ async def get_comprehensive_risk(variants: List[dict], primary_drug: str) -> dic
     
     return panel
 
-@app.post("/analyze/batch")
+@app.post("/analyze/batch", response_model=JSONObject)
 async def analyze_batch(
     drugs: str = Form(...),
     vcf: UploadFile = File(...)
 ):
     """
     Analyze multiple drugs at once (comma-separated)
+    The VCF is parsed once and shared across all drugs, and the LLM
+    explanations for all drugs come from a single batched call.
     """
-    drug_list = [d.strip().upper() for d in drugs.split(',')]
-    
-    # Use the first drug for the main response
-    primary_drug = drug_list[0]
+    # Distinct drug names in request order; blanks from stray commas are ignored
+    drug_list = list(dict.fromkeys(d.strip().upper() for d in drugs.split(',') if d.strip()))
+    if not drug_list:
+        raise HTTPException(status_code=400, detail="No drugs given")
+    if len(drug_list) > MAX_BATCH_DRUGS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_DRUGS} drugs per batch")
+    patient_id = f"PATIENT_{uuid.uuid4().hex[:8].upper()}"
     
-    # Get primary analysis
-    primary_response = await analyze(drug=primary_drug, vcf=vcf)
+    try:
+        variants, parsing_success, file_size_bytes = await _read_vcf_upload(vcf)
+        variant_key = build_variant_key(variants)
+        risks = {drug: _assess_risk(variants, drug, variant_key) for drug in drug_list}
+        explanations = await _batch_explanations(risks)
+        results = await asyncio.gather(*(
+            _analyze_core(variants, drug, patient_id, vcf.filename, file_size_bytes, parsing_success,
+                          variant_key, risks[drug], explanations[drug])
+            for drug in drug_list
+        ))
+    except HTTPException:
+        raise
+    except Exception as e:
+        return _internal_error_response(e)
     
-    # Add batch results
-    if isinstance(primary_response, dict):
-        primary_response["batch_analysis"] = {}
-        for drug in drug_list[1:]:
-            try:
-                # Need to re-read file - in production, save and reuse
-                # This is simplified for hackathon
-                primary_response["batch_analysis"][drug] = "Batch analysis available in comprehensive_panel"
-            except:
-                pass
+    # Use the first drug for the main response
+    primary_response = results[0]
+    primary_response["batch_analysis"] = dict(zip(drug_list[1:], results[1:]))
     
-    return primary_response
\ No newline at end of file
+    return primary_response
+
+async def _batch_explanations(risks: Dict[str, dict]) -> Dict[str, dict]:
+    """
+    LLM explanation per drug. Supported drugs share one batched Gemini call;
+    unsupported names get the fallback without calling the LLM.
+    """
+    pairs = [(drug, risk["phenotype"]) for drug, risk in risks.items() if drug in DRUG_GENE_MAP]
+    try:
+        by_pair = await get_explanations_batch(pairs) if pairs else {}
+    except Exception as e:
+        by_pair = {pair: _explanation_unavailable(*pair) for pair in pairs}
+    return {
+        drug: by_pair[(drug, risk["phenotype"])] if drug in DRUG_GENE_MAP
+        else get_fallback(risk["phenotype"], f"{drug} is not a supported drug")
+        for drug, risk in risks.items()
+    }
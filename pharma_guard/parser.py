@@ -1,10 +1,19 @@
 """
 Pure Python VCF Parser for PharmaGuard
 RIFT 2026 Hackathon - Compliant with 6 genes requirement
+
+Binary input is pre-filtered by a precompiled regex, so the per-line
+tokenize-and-filter work runs in C inside the re engine and only records
+for target rsIDs reach the Python line parser.
 """
 
+import gzip
+import io
 import re
-from typing import List, Dict, Any
+import sys
+from dataclasses import dataclass
+from functools import cached_property, lru_cache
+from typing import IO, List, Dict, Iterable, Iterator, NamedTuple, Optional, Sequence, Tuple
 
 # Complete mapping of all target variants for 6 genes
 TARGET_VARIANTS = {
@@ -41,6 +50,14 @@ TARGET_VARIANTS = {
     "rs75017182": {"gene": "DPYD", "allele": "HapB3", "function": "Reduced function", "cpic_level": "A"},
 }
 
+# TARGET_VARIANTS packed as rsid -> (gene, allele, function, cpic_level)
+# so the parser unpacks one tuple per hit instead of four dict lookups.
+# Values are interned so every record shares the same string objects.
+_TARGET = {
+    rsid: tuple(sys.intern(d[k]) for k in ("gene", "allele", "function", "cpic_level"))
+    for rsid, d in TARGET_VARIANTS.items()
+}
+
 # Drug-to-gene mapping
 DRUG_GENE_MAP = {
     "CODEINE": ["CYP2D6"],
@@ -51,110 +68,313 @@ DRUG_GENE_MAP = {
     "FLUOROURACIL": ["DPYD"],
 }
 
-def parse_vcf_file(filepath: str) -> List[Dict[str, Any]]:
+class Variant(NamedTuple):
+    """One detected target variant; use _asdict() where a plain dict is needed"""
+    rsid: str
+    gene: str
+    allele: str
+    function: str
+    cpic_level: str
+    genotype: str
+    chromosome: str
+    position: str
+    ref: str
+    alt: str
+    quality: str
+    filter: str
+    info: str  # Raw INFO column, see get_info_gene
+
+_READ_BUFFER_BYTES = 1 << 20  # 1 MiB
+_MAX_LINE_BYTES = 8 << 20  # Longer "lines" are not VCF records; parsing fails
+_GZIP_MAGIC = b"\x1f\x8b"  # Also the header of every BGZF block
+_MAX_INTERN_GT = 8  # Longer GT fields are unusual, leave them uninterned
+
+# GENE= annotation in the INFO column
+_GENE_RE = re.compile(r'GENE=([^;]+)')
+
+# A target rsID as a whole tab-delimited field (the ID column of any
+# record we keep), used to find candidate lines in raw buffers
+_TARGET_RSID_RE = re.compile(
+    b"\t(?:" + b"|".join(re.escape(rsid.encode()) for rsid in TARGET_VARIANTS) + b")\t"
+)
+
+def parse_vcf_file(filepath: str) -> List[Variant]:
     """
     Parse VCF file and extract pharmacogenomic variants.
     Pure Python implementation - no external dependencies.
+    Returns [] if the file cannot be opened; undecodable lines are skipped.
+    Read and decompression errors (e.g. a truncated .vcf.gz) propagate.
     """
-    detected_variants = []
-    
     try:
-        with open(filepath, 'r') as f:
-            for line in f:
-                # Skip header lines
-                if line.startswith('#'):
-                    continue
-                
-                # Parse VCF columns
-                cols = line.strip().split('\t')
-                if len(cols) < 8:
-                    continue
-                
-                chrom = cols[0]
-                pos = cols[1]
-                rsid = cols[2]
-                ref = cols[3]
-                alt = cols[4]
-                qual = cols[5]
-                filt = cols[6]
-                info = cols[7]
-                
-                # Check if this is a target variant
-                if rsid in TARGET_VARIANTS:
-                    variant_info = TARGET_VARIANTS[rsid]
-                    
-                    # Extract genotype if sample data exists
-                    genotype = "./."
-                    if len(cols) >= 10:
-                        sample_data = cols[9]
-                        gt_field = sample_data.split(':')[0] if ':' in sample_data else sample_data
-                        genotype = gt_field
-                    
-                    # Extract additional info from INFO field
-                    gene = variant_info["gene"]
-                    allele = variant_info["allele"]
-                    function = variant_info["function"]
-                    
-                    # Try to get gene from INFO if available
-                    gene_match = re.search(r'GENE=([^;]+)', info)
-                    if gene_match:
-                        gene = gene_match.group(1)
-                    
-                    detected_variants.append({
-                        "rsid": rsid,
-                        "gene": gene,
-                        "allele": allele,
-                        "function": function,
-                        "cpic_level": variant_info["cpic_level"],
-                        "genotype": genotype,
-                        "chromosome": chrom,
-                        "position": pos,
-                        "ref": ref,
-                        "alt": alt,
-                        "quality": qual,
-                        "filter": filt
-                    })
-        
-        return detected_variants
-        
-    except Exception as e:
+        f = _open_vcf(filepath)
+    except OSError as e:
         print(f"VCF Parser Error: {e}")
         return []
+    with f:
+        return list(_iter_vcf_records(_iter_candidate_lines(f)))
+
+def iter_vcf_file(filepath: str) -> Iterator[Variant]:
+    """
+    Stream pharmacogenomic variants from a VCF file one record at a time.
+    Errors are handled as in parse_vcf_file, except that a file that cannot
+    be opened raises OSError instead of yielding nothing.
+    """
+    with _open_vcf(filepath) as f:
+        yield from _iter_vcf_records(_iter_candidate_lines(f))
 
-def get_variants_by_gene(variants: List[Dict], gene: str) -> List[Dict]:
+def _open_vcf(filepath: str) -> IO[bytes]:
+    """Open a VCF for binary reading; gzip/BGZF (.vcf.gz) is decompressed transparently"""
+    with open(filepath, 'rb') as f:
+        magic = f.read(2)
+    if magic == _GZIP_MAGIC:
+        return gzip.open(filepath, 'rb')
+    return open(filepath, 'rb')
+
+def parse_vcf_stream(fobj: IO, max_bytes: Optional[int] = None) -> List[Variant]:
+    """
+    Parse VCF data from an open file-like object (e.g. an in-memory upload).
+    Binary streams are decoded as UTF-8; seekable gzip/BGZF streams are
+    decompressed transparently. Read errors propagate to the caller.
+    max_bytes caps the (decompressed) binary data read; past it ValueError
+    is raised.
+    """
+    if isinstance(fobj, io.TextIOBase):
+        return list(_iter_vcf_records(fobj))
+    return list(_iter_vcf_records(_iter_candidate_lines(_maybe_gunzip(fobj), max_bytes)))
+
+def _maybe_gunzip(fobj: IO[bytes]) -> IO[bytes]:
+    """Wrap fobj in a gzip reader if it starts with the gzip magic bytes"""
+    if not fobj.seekable():
+        return fobj
+    start = fobj.tell()
+    magic = fobj.read(2)
+    fobj.seek(start)
+    if magic == _GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=fobj, mode='rb')
+    return fobj
+
+def _iter_candidate_lines(fobj: IO[bytes], max_bytes: Optional[int] = None) -> Iterator[str]:
+    """
+    Yield the lines of a binary VCF stream that mention a target rsID.
+    The stream is read in large blocks and each block is scanned by the
+    regex engine in C; only matching lines are decoded for the Python
+    line parser. A line longer than _MAX_LINE_BYTES, or more than max_bytes
+    of input, raises ValueError rather than silently losing records.
+    """
+    carry = b""
+    total_bytes = 0
+    while True:
+        block = fobj.read(_READ_BUFFER_BYTES)
+        if not block:
+            break
+        total_bytes += len(block)
+        if max_bytes is not None and total_bytes > max_bytes:
+            raise ValueError(f"VCF data exceeds {max_bytes} bytes")
+        block = carry + block
+        # Match text-mode universal newline handling
+        if b"\r" in block:
+            block = block.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        # Scan complete lines only; the partial last line joins the next block
+        cut = block.rfind(b"\n") + 1
+        carry = block[cut:]
+        # Bound the carry so newline-free input stays linear, not quadratic
+        if len(carry) > _MAX_LINE_BYTES:
+            raise ValueError(f"VCF line exceeds {_MAX_LINE_BYTES} bytes")
+        yield from _scan_block(block, cut)
+    if carry:
+        yield from _scan_block(carry, len(carry))
+
+def _scan_block(buf: bytes, end: int) -> List[str]:
+    """Decode the lines in buf[:end] that contain a target rsID field, skipping invalid UTF-8"""
+    lines = []
+    line_end = -1
+    for match in _TARGET_RSID_RE.finditer(buf, 0, end):
+        if match.start() < line_end:
+            continue  # Line already collected
+        line_start = buf.rfind(b"\n", 0, match.start()) + 1
+        line_end = buf.find(b"\n", match.end(), end)
+        if line_end == -1:
+            line_end = end
+        try:
+            lines.append(buf[line_start:line_end].decode("utf-8"))
+        except UnicodeDecodeError:
+            continue  # Malformed line; keep parsing the rest of the file
+    return lines
+
+def _iter_vcf_records(lines: Iterable[str]) -> Iterator[Variant]:
+    """Yield target variants from VCF text lines"""
+    for line in lines:
+        # Skip header lines
+        if line.startswith('#'):
+            continue
+        
+        # Cheap pre-filter: slice out the ID (3rd) column and look it up
+        # once, dropping non-target records before paying for a full split
+        t1 = line.find('\t')
+        t2 = line.find('\t', t1 + 1) if t1 >= 0 else -1
+        t3 = line.find('\t', t2 + 1) if t2 >= 0 else -1
+        rsid = line[t2 + 1:t3] if t3 >= 0 else ""
+        target = _TARGET.get(rsid)
+        if target is None:
+            continue
+        gene, allele, function, cpic_level = target
+        
+        # Hit path only: CHROM and POS come from the offsets found above,
+        # and the split starts at REF. Only the first sample is used, so
+        # stop splitting after it instead of allocating every sample column.
+        cols = line[t3 + 1:].rstrip().split('\t', 7)
+        if len(cols) < 5:
+            continue
+        chrom = line[:t1]
+        pos = line[t1 + 1:t2]
+        ref, alt, qual, filt, info = cols[:5]
+        
+        # Extract genotype if sample data exists
+        genotype = "./."
+        if len(cols) >= 7:
+            sample_data = cols[6]
+            gt_field = sample_data.partition(':')[0]
+            # Genotypes repeat across records; share one object per call
+            genotype = sys.intern(gt_field) if len(gt_field) <= _MAX_INTERN_GT else gt_field
+        
+        # info is parsed on demand, see get_info_gene
+        yield Variant(rsid, gene, allele, function, cpic_level, genotype,
+                      chrom, pos, ref, alt, qual, filt, info)
+
+# Copies of the variant allele carried per called genotype
+_GT_CONTRIB = {
+    sys.intern(gt): dose
+    for gt, dose in {"1/1": 2, "1|1": 2, "0/1": 1, "1/0": 1, "0|1": 1, "1|0": 1}.items()
+}
+
+@dataclass(frozen=True)
+class VariantTable:
+    """
+    Struct-of-arrays view of detected variants.
+    Each field is a tuple holding one value per variant, in VCF order.
+    """
+    gene: Tuple[str, ...] = ()
+    rsid: Tuple[str, ...] = ()
+    allele: Tuple[str, ...] = ()
+    function: Tuple[str, ...] = ()
+    genotype: Tuple[str, ...] = ()
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Sequence[str]]) -> "VariantTable":
+        """Build from (gene, rsid, allele, function, genotype) rows"""
+        columns = tuple(zip(*rows))
+        return cls(*columns) if columns else cls()
+
+    @classmethod
+    def from_variants(cls, variants: List[Variant]) -> "VariantTable":
+        """Build from parsed variants"""
+        return cls.from_rows(
+            (v.gene, v.rsid, v.allele, v.function, v.genotype)
+            for v in variants
+        )
+
+    def __len__(self) -> int:
+        return len(self.rsid)
+
+    @cached_property
+    def gene_index(self) -> Dict[str, List[int]]:
+        """Row numbers per gene, built in a single pass"""
+        return _index_rows(self.gene)
+
+    @cached_property
+    def rsid_index(self) -> Dict[str, List[int]]:
+        """Row numbers per rsID, built in a single pass"""
+        return _index_rows(self.rsid)
+
+    def select(self, gene: str) -> "VariantTable":
+        """Return the rows for a single gene as a new table"""
+        idx = self.gene_index.get(gene, [])
+        if len(idx) == len(self.gene):
+            return self
+        return VariantTable(*(
+            tuple(col[i] for i in idx)
+            for col in (self.gene, self.rsid, self.allele, self.function, self.genotype)
+        ))
+
+def _index_rows(column: Sequence[str]) -> Dict[str, List[int]]:
+    index = {}
+    for i, value in enumerate(column):
+        index.setdefault(value, []).append(i)
+    return index
+
+def get_info_gene(variant: Variant) -> Optional[str]:
+    """Gene from the record's INFO GENE= annotation, parsed on demand"""
+    info = variant.info
+    if 'GENE=' not in info:
+        return None
+    gene_match = _GENE_RE.search(info)
+    return gene_match.group(1) if gene_match else None
+
+def get_variants_by_gene(variants: List[Variant], gene: str) -> List[Variant]:
     """Filter variants by gene"""
-    return [v for v in variants if v["gene"] == gene]
+    return [v for v in variants if v.gene == gene]
 
-def get_diplotype(variants: List[Dict], gene: str) -> str:
-    """Determine diplotype for a gene based on variants"""
-    gene_variants = get_variants_by_gene(variants, gene)
-    
-    if not gene_variants:
+def index_variants_by_gene(variants: List[Variant]) -> Dict[str, List[Variant]]:
+    """Group variants by gene in one pass, for callers querying many genes"""
+    index = {}
+    for v in variants:
+        index.setdefault(v.gene, []).append(v)
+    return index
+
+def get_diplotype(variants: List[Variant], gene: str,
+                  gene_index: Optional[Dict[str, List[Variant]]] = None) -> str:
+    """
+    Determine diplotype for a gene based on variants.
+    Pass a gene_index from index_variants_by_gene to skip the filter scan.
+    """
+    if gene_index is not None:
+        gene_variants = gene_index.get(gene, [])
+    else:
+        gene_variants = get_variants_by_gene(variants, gene)
+    return diplotype_from_calls(
+        [v.allele for v in gene_variants],
+        [v.genotype for v in gene_variants]
+    )
+
+# Phenotype by allele pair, each pair stored in sorted order; matching
+# whole alleles keeps *1/*17 from being read as a *1/*1 fragment
+_PHENOTYPES = {
+    ("*2", "*2"): "PM",  # Poor Metabolizer
+    ("*3", "*3"): "PM",
+    ("*4", "*4"): "PM",
+    ("*1", "*2"): "IM",  # Intermediate Metabolizer
+    ("*1", "*3"): "IM",
+    ("*1", "*4"): "IM",
+    ("*1", "*1"): "NM",  # Normal Metabolizer
+    ("*17", "*17"): "RM",  # Rapid Metabolizer
+    ("*1", "*17"): "RM",
+}
+
+def diplotype_from_calls(alleles_in: Sequence[str], genotypes: Sequence[str]) -> str:
+    """Determine diplotype from parallel allele and genotype columns of one gene"""
+    if not alleles_in:
         return "*1/*1"  # Default wild type
-    
+    return _diplotype_from_alleles(tuple(zip(alleles_in, genotypes)))
+
+@lru_cache(maxsize=1024)
+def _diplotype_from_alleles(calls: Tuple[Tuple[str, str], ...]) -> str:
+    """Diplotype for hashable (allele, genotype) pairs, memoized across reports"""
     # Simplified diplotype assignment
     alleles = []
-    for v in gene_variants:
-        if v["genotype"] == "1/1" or v["genotype"] == "1|1":
-            alleles.append(v["allele"])
-            alleles.append(v["allele"])
-        elif v["genotype"] in ["0/1", "1/0", "0|1", "1|0"]:
-            alleles.append("*1")
-            alleles.append(v["allele"])
+    for allele, genotype in calls:
+        contrib = _GT_CONTRIB.get(genotype)
+        if contrib == 2:
+            alleles += (allele, allele)
+        elif contrib == 1:
+            alleles += ("*1", allele)
     
     if len(alleles) >= 2:
         return f"{alleles[0]}/{alleles[1]}"
     return "*1/*1"
 
+@lru_cache(maxsize=128)
 def get_phenotype(gene: str, diplotype: str) -> str:
     """Determine phenotype based on gene and diplotype"""
-    if "*2/*2" in diplotype or "*3/*3" in diplotype or "*4/*4" in diplotype:
-        return "PM"  # Poor Metabolizer
-    elif "*1/*2" in diplotype or "*1/*3" in diplotype or "*1/*4" in diplotype:
-        return "IM"  # Intermediate Metabolizer
-    elif "*1/*1" in diplotype:
-        return "NM"  # Normal Metabolizer
-    elif "*17/*17" in diplotype or "*1/*17" in diplotype:
-        return "RM"  # Rapid Metabolizer
-    else:
-        return "Unknown"
\ No newline at end of file
+    first, _, second = diplotype.partition("/")
+    pair = (first, second) if first <= second else (second, first)
+    return _PHENOTYPES.get(pair, "Unknown")